@@ -324,8 +324,10 @@ class TrainState(train_state.TrainState):
             new_params = new_master_params
         else:
             new_master_copy = new_master_params
+            # Cast the updated master copy back to the dtype of the params
             new_params = jax.tree_util.tree_map(
-                lambda x: jnp.asarray(x, dtype=jnp.float16), new_master_params)
+                lambda x, y: jnp.asarray(x, dtype=y.dtype), new_master_params,
+                self.params)
 
             # A hack to make the donation works perfectly in gradient accumulation:
             # We need the accumulate_grad to take the old params as input.
@@ -345,14 +347,25 @@ class TrainState(train_state.TrainState):
         )
 
     @classmethod
-    def create(cls, *, apply_fn, params, tx, mixed_precision=False, **kwargs):
-        """Creates a new instance with `step=0` and initialized `opt_state`."""
+    def create(cls,
+               *,
+               apply_fn,
+               params,
+               tx,
+               mixed_precision=False,
+               dtype=jnp.float16,
+               **kwargs):
+        """Creates a new instance with `step=0` and initialized `opt_state`.
+
+        If mixed_precision is True, the params are cast to `dtype` and the
+        original params are kept as the master copy.
+        """
         opt_state = tx.init(params)
 
         if mixed_precision:
             master_copy = params
             params = jax.tree_util.tree_map(
-                lambda x: jnp.asarray(x, dtype=jnp.float16), params)
+                lambda x: jnp.asarray(x, dtype=dtype), params)
         else:
             master_copy = None
 
@@ -373,6 +386,7 @@ class TrainState(train_state.TrainState):
                     params,
                     tx,
                     mixed_precision=False,
+                    dtype=jnp.float16,
                     **kwargs):
         """Creates a new instance with `step=0` and initialized `opt_state`."""
         opt_state = jax.eval_shape(tx.init, params)
@@ -381,7 +395,7 @@ class TrainState(train_state.TrainState):
             master_copy = params
             params = jax.eval_shape(
                 lambda p: jax.tree_util.tree_map(
-                    lambda x: jnp.asarray(x, dtype=jnp.float16), p), params)
+                    lambda x: jnp.asarray(x, dtype=dtype), p), params)
         else:
             master_copy = None
 
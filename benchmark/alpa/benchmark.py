@@ -47,7 +47,8 @@ def benchmark_suite(suite_name,
                     local=False,
                     profile_driver_time=False,
                     disable_tqdm=False,
-                    use_separate_process=True):
+                    use_separate_process=True,
+                    bf16=False):
     num_gpus = num_hosts * num_devices_per_host
 
     if local:
@@ -61,6 +62,9 @@ def benchmark_suite(suite_name,
     os.makedirs("tmp", exist_ok=True)
 
     model_type = suite_name.split(".")[0]
+    if bf16 and model_type not in ["gpt", "bert"]:
+        raise NotImplementedError(f"Cannot support bf16 for {model_type}")
+    dtype = "bf16" if bf16 else "fp16"
     date_str = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     output_name = f"{model_type}_alpa_{exp_name}_{date_str}.tsv"
 
@@ -81,18 +85,19 @@ def benchmark_suite(suite_name,
                                     local=local,
                                     profile_driver_time=profile_driver_time,
                                     disable_tqdm=disable_tqdm,
-                                    use_separate_process=use_separate_process)
+                                    use_separate_process=use_separate_process,
+                                    bf16=bf16)
 
         (parameter_count, peak_mem, latencies, tflops, metadata) = result
 
         heads = [
             "Type", "Model Config", "#Microbatch", "#GPU", "Parallel Config",
-            "Mean Time (s)", "Std Time (s)", "#Params (Billion)", "TFLOPs",
-            "Peak Mem (GB)", "Metadata"
+            "Dtype", "Mean Time (s)", "Std Time (s)", "#Params (Billion)",
+            "TFLOPs", "Peak Mem (GB)", "Metadata"
         ]
         values = [
             model_type, model_config, num_micro_batches, num_gpus,
-            parallel_args, f"{np.mean(latencies):.3f}",
+            parallel_args, dtype, f"{np.mean(latencies):.3f}",
             f"{np.std(latencies):.3f}", f"{parameter_count/1e9:.3f}B",
             f"{tflops:.2f}", f"{peak_mem/GB:.3f}",
             to_str_round(metadata, 2)
@@ -133,6 +138,9 @@ if __name__ == "__main__":
                         dest="use_separate_process")
     parser.add_argument("--exp_name", type=str, default="default")
     parser.add_argument("--disable-tqdm", action="store_true")
+    parser.add_argument("--bf16",
+                        action="store_true",
+                        help="Train GPT/BERT in bfloat16 instead of float16.")
     args = parser.parse_args()
 
     num_hosts, num_devices_per_host = get_num_hosts_and_num_devices(args)
@@ -140,4 +148,4 @@ if __name__ == "__main__":
     benchmark_suite(args.suite, num_hosts, num_devices_per_host, args.exp_name,
                     args.niter, args.shard_only, args.local,
                     args.profile_driver_time, args.disable_tqdm,
-                    args.use_separate_process)
+                    args.use_separate_process, args.bf16)
@@ -4,6 +4,7 @@ import argparse
 import multiprocessing as mp
 
 import jax
+import jax.numpy as jnp
 
 from alpa import (init, global_config, get_global_cluster,
                   LocalPhysicalDeviceMesh)
@@ -27,10 +28,15 @@ def benchmark_one_case_internal(model,
                                 profile_driver_time=False,
                                 shard_only=False,
                                 local=False,
-                                disable_tqdm=False):
+                                disable_tqdm=False,
+                                bf16=False):
     if disable_tqdm:
         disable_tqdm_globally()
 
+    if bf16 and model not in ["gpt", "bert"]:
+        raise NotImplementedError(f"Cannot support bf16 for {model}")
+    dtype = jnp.bfloat16 if bf16 else jnp.float16
+
     # local mode does not support dummy value
     global_config.use_dummy_value_for_benchmarking = not local
 
@@ -52,7 +58,8 @@ def benchmark_one_case_internal(model,
                 model,
                 case,
                 niter,
-                profile_driver_time=profile_driver_time)
+                profile_driver_time=profile_driver_time,
+                dtype=dtype)
         elif model == "moe":
             result = benchmark_moe_2d_internal(
                 physical_mesh,
@@ -84,7 +91,8 @@ def benchmark_one_case_internal(model,
                 niter,
                 num_hosts,
                 num_devices_per_host,
-                profile_driver_time=profile_driver_time)
+                profile_driver_time=profile_driver_time,
+                dtype=dtype)
         elif model == "moe":
             result = benchmark_moe_3d_internal(
                 case,
@@ -157,6 +165,9 @@ if __name__ == "__main__":
                         help="Profile the execution time on the driver instead "
                         "of the workers.")
     parser.add_argument("--disable-tqdm", action="store_true")
+    parser.add_argument("--bf16",
+                        action="store_true",
+                        help="Train GPT/BERT in bfloat16 instead of float16.")
     args = parser.parse_args()
 
     os.makedirs("tmp", exist_ok=True)
@@ -176,6 +187,7 @@ if __name__ == "__main__":
                                 shard_only=args.shard_only,
                                 local=args.local,
                                 profile_driver_time=args.profile_driver_time,
-                                disable_tqdm=args.disable_tqdm)
+                                disable_tqdm=args.disable_tqdm,
+                                bf16=args.bf16)
 
     print(result)
@@ -64,11 +64,12 @@ def create_train_state(rngkey, model, batch, dtype):
     tx = optax.chain(
         #optax.clip_by_global_norm(1.0),  # TODO(lmzheng): fix reduce-scatter for this
         optax.adamw(learning_rate=1e-2, mask=weight_decay_mask))
-    mixed_precision = (dtype == jnp.float16)
+    mixed_precision = dtype in (jnp.float16, jnp.bfloat16)
     state = TrainState.create(apply_fn=model.apply,
                               params=params,
                               tx=tx,
                               mixed_precision=mixed_precision,
+                              dtype=dtype,
                               dynamic_scale=None)
     return state
 
@@ -85,11 +86,12 @@ def create_train_state_aval(rngkey, model, batch, dtype):
     tx = optax.chain(
         #optax.clip_by_global_norm(1.0),  # TODO(lmzheng): fix reduce-scatter for this
         optax.adamw(learning_rate=1e-2, mask=weight_decay_mask))
-    mixed_precision = (dtype == jnp.float16)
+    mixed_precision = dtype in (jnp.float16, jnp.bfloat16)
     state = TrainState.create_aval(apply_fn=model.apply,
                                    params=params,
                                    tx=tx,
                                    mixed_precision=mixed_precision,
+                                   dtype=dtype,
                                    dynamic_scale=None)
     return state
 
@@ -102,7 +104,7 @@ def get_train_step(parallel_method,
     if grad_func is None:
         grad_func = alpa.grad
 
-    @parallelize(method=parallel_method)
+    @parallelize(method=parallel_method, donate_argnums=(0,))
     def train_step(state, batch, rng_key):
 
         def loss_func(params):
@@ -114,10 +116,15 @@ def get_train_step(parallel_method,
                                     batch["position_ids"],
                                     deterministic=True,
                                     rngs=rngs)[0]
-            label_mask = jnp.where(batch["labels"] > 0, 1.0, 0.0)
-            labels = jax.nn.one_hot(batch["labels"], logits.shape[-1])
-            loss = -jnp.sum(labels * jax.nn.log_softmax(logits, axis=-1),
-                            axis=-1)
+            labels = batch["labels"]
+            label_mask = (labels > 0).astype(jnp.float32)
+            # Select the label logits with a fused compare-and-reduce instead
+            # of materializing a (batch, seq, vocab) one-hot tensor. Unlike
+            # a gather, this keeps the vocab dim shardable.
+            vocab_ids = jnp.arange(logits.shape[-1])
+            label_logits = jnp.where(vocab_ids == labels[..., None], logits,
+                                     0.0).sum(axis=-1)
+            loss = jax.nn.logsumexp(logits, axis=-1) - label_logits
             loss = (label_mask * loss).sum() / label_mask.sum()
             return loss
 
@@ -139,16 +146,16 @@ def prepare_gpt_bert_input_and_model(model_type,
                                      add_manual_layer_marker=None,
                                      num_manual_pipeline_stages=None,
                                      aval_train_state=True,
-                                     tie_word_embeddings=False):
+                                     tie_word_embeddings=False,
+                                     dtype=jnp.float16):
     print_used_time(None)
     batch_size = benchmark_case.batch_size
     (seq_len, hidden_size, num_layers, num_heads,
      vocab_size) = benchmark_case.model_config
-    dtype = jnp.float16
     # Prepare input batch
     batch = {
         "input_ids": jnp.ones((batch_size, seq_len), dtype=jnp.int32),
-        "attention_mask": jnp.ones((batch_size, seq_len), dtype=jnp.int32),
+        "attention_mask": jnp.ones((batch_size, seq_len), dtype=jnp.uint8),
         "token_type_ids": jnp.ones((batch_size, seq_len), dtype=jnp.int32),
         "position_ids": jnp.ones((batch_size, seq_len), dtype=jnp.int32),
         "labels": jnp.ones((batch_size, seq_len), dtype=jnp.int32),
@@ -210,7 +217,8 @@ def benchmark_gpt_bert_3d_internal(model_type,
                                    num_hosts,
                                    num_devices_per_host,
                                    aval_train_state=True,
-                                   profile_driver_time=False):
+                                   profile_driver_time=False,
+                                   dtype=jnp.float16):
     # Connect to the cluster
     virtual_mesh = get_global_cluster().get_virtual_physical_mesh(
         host_ids=list(range(num_hosts)),
@@ -236,7 +244,8 @@ def benchmark_gpt_bert_3d_internal(model_type,
         add_manual_remat=add_manual_remat,
         add_manual_layer_marker=add_manual_layer_marker,
         num_manual_pipeline_stages=num_manual_pipeline_stages,
-        aval_train_state=aval_train_state)
+        aval_train_state=aval_train_state,
+        dtype=dtype)
 
     train_step = get_train_step(method, use_fine_grained_remat,
                                 fine_grained_remat_num_layers)
@@ -275,14 +284,16 @@ def benchmark_gpt_bert_2d_internal(physical_mesh,
                                    model_type,
                                    benchmark_case,
                                    niter,
-                                   profile_driver_time=False):
+                                   profile_driver_time=False,
+                                   dtype=jnp.float16):
     method, grad_func = get_shard_parallel_method(benchmark_case, physical_mesh)
 
     state, batch, rngkey = prepare_gpt_bert_input_and_model(
         model_type,
         benchmark_case,
         add_manual_remat=benchmark_case.parallel_args.use_remat,
-        aval_train_state=global_config.use_dummy_value_for_benchmarking)
+        aval_train_state=global_config.use_dummy_value_for_benchmarking,
+        dtype=dtype)
 
     train_step = get_train_step(method, grad_func=grad_func)
 
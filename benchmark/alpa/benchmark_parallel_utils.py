@@ -11,6 +11,7 @@ import alpa
 from alpa import (AutoShardingOption, ShardParallel, PipeshardParallel,
                   ManualStageOption, AutoStageOption, AutoLayerOption,
                   global_config, PhysicalDeviceMesh)
+from alpa.mesh_executable import NormalMeshDriverExecutable
 from alpa.timer import timers
 from alpa.util import (print_used_time, to_str_round,
                        count_communication_primitives, GB)
@@ -374,6 +375,11 @@ def compile_and_benchmark_shard_training_executable(physical_mesh,
                                                     profile_driver_time=False):
     executable, ilp_objective, alloc_mem = compile_shard_executable(
         physical_mesh, train_step, state, other_train_step_inputs)
+    if isinstance(executable, NormalMeshDriverExecutable):
+        # Preshard the inputs once, so that the benchmark loop does not
+        # transfer the batch to the devices in every iteration.
+        state, *other_train_step_inputs = train_step.preshard_dynamic_args(
+            state, *other_train_step_inputs)
     latencies = benchmark_training_executable(
         niter,
         train_step,
@@ -3,6 +3,12 @@
 Usages:
 1. benchmark huggingface torch-based OPT or GPT-2 generation:
 python benchmark_text_gen.py --model facebook/opt-125m --debug
+    (add --torch-compile to compile the model with torch.compile, and
+    --cuda-graph to replay the OPT decoding steps from a CUDA graph, and
+    --quantize-lm-head to run the OPT lm_head in int8)
+
+   add --fast-generate to any of the generation benchmarks to decode greedily
+   with a minimal loop instead of huggingface's generate.
 
 2. benchmark jax.jit based OPT generation without alpa, on a single GPU:
 python benchmark_text_gen.py --model jax/opt-125m
@@ -56,11 +62,16 @@ if __name__ == "__main__":
     parser.add_argument("--num-beams", type=int, default=1)
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--dtype", type=str, default="fp16")
+    parser.add_argument("--torch-compile", action="store_true")
+    parser.add_argument("--cuda-graph", action="store_true")
+    parser.add_argument("--quantize-lm-head", action="store_true")
+    parser.add_argument("--fast-generate", action="store_true")
     args = parser.parse_args()
 
     # Some global params
     warmup_iters = 5
     n_iters = 10
+    max_length = 256
     global_config.pipeline_sync_for_timer = True
     global_config.shard_parallel_sync_for_timer = True
 
@@ -81,8 +92,13 @@ if __name__ == "__main__":
         assert num_micro_batches == 1, "we only support num_micro_batches=1 for autoregressive!"
         assert decoder_length_per_step == 1, "Decoding one token at a time!"
         assert batch_size == 1, "batch_size > 1 in autoregressive is not tested!"
+    if args.fast_generate:
+        assert num_beams == 1, "fast_generate only supports greedy decoding!"
 
-    decode_speeds = []
+    # The speed is the total number of tokens over the total latency,
+    # not the mean of the per-iteration speeds.
+    total_tokens = 0
+    total_latency = 0.0
     tflopss = []
     compute_tflopss = []
 
@@ -128,9 +144,8 @@ if __name__ == "__main__":
             model.sync()
 
         # benchmark
+        torch.manual_seed(8)
         for i in range(n_iters):
-            torch.manual_seed(8)
-
             tic = time.time()
             forward_results = model(params, {
                 "input_ids": input_ids,
@@ -155,14 +170,16 @@ if __name__ == "__main__":
             compute_tflops = compute_gpt_tflops_inference_with_padding(
                 batch_size, decoder_length_per_step, seq_len, L, H, vocab_size,
                 num_gpus, compute_latency)
-            speed = np.prod(input_ids.shape) / latency
+            num_tokens = np.prod(input_ids.shape)
+            speed = num_tokens / latency
 
             if args.debug:
                 print(
                     f"speed: {speed:.2f} token/s, E2E tflops: {tflops:.4f}, compute tflops: {compute_tflops:.4f}, "
                     f"memory: {memory_allocated}, max memory: {max_memory_allocated}"
                 )
-            decode_speeds.append(speed)
+            total_tokens += num_tokens
+            total_latency += latency
             tflopss.append(tflops)
             compute_tflopss.append(compute_tflops)
     else:
@@ -174,18 +191,28 @@ if __name__ == "__main__":
                           autoregressive,
                           dtype=dtype,
                           dummy=args.dummy,
-                          num_beams=num_beams)
+                          num_beams=num_beams,
+                          max_length=max_length,
+                          torch_compile=args.torch_compile,
+                          cuda_graph=args.cuda_graph,
+                          quantize_lm_head=args.quantize_lm_head)
         load_time = time.time() - tic
 
         # warm up
         input_ids = tokenizer("Paris is the capital city of",
                               return_tensors="pt").input_ids.to(args.device)
-        output = model.generate(input_ids=input_ids,
-                                max_length=256,
-                                do_sample=False,
-                                return_dict_in_generate=True,
-                                output_hidden_states=False,
-                                num_beams=num_beams)
+        def generate(input_ids):
+            if args.fast_generate:
+                return model.fast_generate(input_ids, max_length=max_length)
+            output = model.generate(input_ids=input_ids,
+                                    max_length=max_length,
+                                    do_sample=False,
+                                    return_dict_in_generate=True,
+                                    output_hidden_states=False,
+                                    num_beams=num_beams)
+            return output.sequences
+
+        generate(input_ids)
 
         H = model.transformer_config.H
         L = model.transformer_config.L
@@ -199,23 +226,21 @@ if __name__ == "__main__":
         else:
             num_gpus = 1
 
+        # Tokenize all prompts before benchmarking
+        prompt_ids = [
+            tokenizer(prompt, return_tensors="pt").input_ids.to(args.device)
+            for prompt in test_prompts[:n_iters]
+        ]
+
         # benchmark
-        for i in range(min(n_iters, len(test_prompts))):
-            prompt = test_prompts[i]
-            torch.manual_seed(8)
-            input_ids = tokenizer(prompt,
-                                  return_tensors="pt").input_ids.to(args.device)
+        # Detokenizing and printing are deferred until all prompts are
+        # generated, so that the host work does not delay the next prompt.
+        results = []
+        torch.manual_seed(8)
+        for input_ids in prompt_ids:
             tic = time.time()
-            output = model.generate(input_ids=input_ids,
-                                    max_length=256,
-                                    do_sample=False,
-                                    return_dict_in_generate=True,
-                                    output_hidden_states=False,
-                                    num_beams=num_beams)
+            generated_ids = generate(input_ids)
             latency = time.time() - tic
-            generated_ids = output.sequences
-            generated_string = tokenizer.batch_decode(generated_ids,
-                                                      skip_special_tokens=True)
 
             gen_len = generated_ids.shape[1]
 
@@ -230,18 +255,25 @@ if __name__ == "__main__":
             compute_tflops = compute_gpt_tflops_inference_with_padding(
                 num_beams * batch_size, gen_len, seq_len, L, H, vocab_size,
                 num_gpus, compute_latency)
-            speed = np.prod(generated_ids.shape) / latency
-            if args.debug:
+            num_tokens = np.prod(generated_ids.shape)
+            speed = num_tokens / latency
+            results.append((input_ids, generated_ids, speed, tflops))
+            total_tokens += num_tokens
+            total_latency += latency
+            tflopss.append(tflops)
+            compute_tflopss.append(compute_tflops)
+
+        if args.debug:
+            for input_ids, generated_ids, speed, tflops in results:
+                generated_string = tokenizer.batch_decode(
+                    generated_ids, skip_special_tokens=True)
                 print(
                     f"input length: {input_ids.shape[1]}, output_length: {generated_ids.shape[1]}, "
                     f"num_gpus: {num_gpus}, speed: {speed:.2f} tokens/s, tflops: {tflops:.4f} tflops/s"
                 )
                 print(generated_string)
-            decode_speeds.append(speed)
-            tflopss.append(tflops)
-            compute_tflopss.append(compute_tflops)
 
-    avg_speed = np.mean(decode_speeds)
+    avg_speed = total_tokens / total_latency
     avg_tflops = np.mean(tflopss)
     avg_compute_tflops = np.mean(compute_tflopss)
     latency_32_tokens = 32.0 / (avg_speed / batch_size)
@@ -0,0 +1,194 @@
+"""Run the decoding steps of huggingface OPT models on a static attention cache.
+
+HuggingFace's past_key_values grow by one token every decoding step, so the
+shapes of a step change all the time and the step cannot be captured in a
+CUDA graph. OPTStaticDecoder runs the decoding steps on preallocated
+key/value buffers instead, which makes all shapes static. On GPUs, the step
+is captured once in a CUDA graph and replayed, which replaces the dozens of
+kernel launches per layer with a single launch.
+"""
+import torch
+
+
+class StaticKVCache:
+    """Preallocated key/value buffers of max_length tokens for all layers.
+
+    The keys and values of all layers are stored in two contiguous tensors
+    of shape (num_layers, batch_size, num_heads, max_length, head_dim)
+    instead of 2 * num_layers separate allocations, so the whole cache can
+    be filled or reordered with a few kernels.
+    """
+
+    def __init__(self, num_layers, batch_size, num_heads, max_length, head_dim,
+                 dtype, device):
+        shape = (num_layers, batch_size, num_heads, max_length, head_dim)
+        self.key_all = torch.zeros(shape, dtype=dtype, device=device)
+        self.value_all = torch.zeros(shape, dtype=dtype, device=device)
+        self.max_length = max_length
+        # The number of filled tokens
+        self.length = 0
+
+    @property
+    def key_values(self):
+        """The per-layer (key, value) views of the buffers."""
+        return tuple(zip(self.key_all.unbind(0), self.value_all.unbind(0)))
+
+    def fill(self, past_key_values):
+        """Copy huggingface's past_key_values into the buffers."""
+        length = past_key_values[0][0].shape[2]
+        if length > self.max_length:
+            raise RuntimeError(
+                f"The prompt length ({length}) exceeds the attention cache "
+                f"size ({self.max_length}).")
+        self.key_all[:, :, :, :length].copy_(
+            torch.stack([key for key, _ in past_key_values]))
+        self.value_all[:, :, :, :length].copy_(
+            torch.stack([value for _, value in past_key_values]))
+        self.length = length
+
+    def reorder(self, beam_idx):
+        """Reorder the batch dimension in place for beam search."""
+        length = self.length
+        for buf in (self.key_all, self.value_all):
+            buf[:, :, :, :length].copy_(buf[:, :, :, :length].index_select(
+                1, beam_idx))
+
+
+class OPTStaticDecoder:
+    """Decode one token per sequence of an OPTForCausalLM on a StaticKVCache.
+
+    The prompt is prefilled with the huggingface decoder, whose
+    past_key_values are then copied into the static cache with
+    StaticKVCache.fill. If use_cuda_graph is True, the decoding step is
+    captured in a CUDA graph on its first call and replayed afterwards.
+    """
+
+    def __init__(self, raw_model, batch_size, max_length, use_cuda_graph):
+        config = raw_model.config
+        self.decoder = raw_model.model.decoder
+        self.lm_head = raw_model.lm_head
+        # The lm_head may be quantized, so take the dtype from the embedding.
+        weight = self.decoder.embed_tokens.weight
+        self.cache = StaticKVCache(
+            config.num_hidden_layers, batch_size, config.num_attention_heads,
+            max_length, config.hidden_size // config.num_attention_heads,
+            weight.dtype, weight.device)
+        self.position_offset = getattr(self.decoder.embed_positions, "offset",
+                                       2)
+        self.use_cuda_graph = use_cuda_graph
+        self.graph = None
+
+        # The static inputs and outputs of the decoding step
+        self.positions = torch.arange(max_length, device=weight.device)
+        self.input_ids = torch.zeros((batch_size, 1),
+                                     dtype=torch.long,
+                                     device=weight.device)
+        self.cache_index = torch.zeros((1,),
+                                       dtype=torch.long,
+                                       device=weight.device)
+        self.logits = None
+
+    def decode(self, input_ids):
+        """Run one token per sequence and return its logits.
+
+        With CUDA graphs, the logits are copied out of the static output
+        buffer, because the generator may keep them across steps.
+        """
+        if self.cache.length >= self.cache.max_length:
+            raise RuntimeError(
+                f"The sequence length exceeds the attention cache size "
+                f"({self.cache.max_length}). Increase max_length in get_model.")
+        self.input_ids.copy_(input_ids)
+        self.cache_index.fill_(self.cache.length)
+        if self.use_cuda_graph:
+            if self.graph is None:
+                self._capture()
+            self.graph.replay()
+            logits = self.logits.clone()
+        else:
+            logits = self._step()
+        self.cache.length += 1
+        return logits
+
+    def _capture(self):
+        # Warm up on a side stream before capturing, as CUDA graphs require.
+        # The warmup step writes the same keys/values as the replayed step.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.logits = self._step()
+
+    def _step(self):
+        decoder = self.decoder
+        cache_index = self.cache_index
+
+        hidden_states = decoder.embed_tokens(self.input_ids)
+        if decoder.project_in is not None:
+            hidden_states = decoder.project_in(hidden_states)
+        hidden_states = hidden_states + decoder.embed_positions.weight[
+            cache_index + self.position_offset]
+
+        # Mask out the cache slots after the current token
+        dtype = hidden_states.dtype
+        attention_bias = torch.zeros(self.positions.shape,
+                                     dtype=dtype,
+                                     device=hidden_states.device)
+        attention_bias.masked_fill_(self.positions > cache_index,
+                                    torch.finfo(dtype).min)
+
+        for layer, (key_cache, value_cache) in zip(decoder.layers,
+                                                   self.cache.key_values):
+            hidden_states = self._layer_step(layer, hidden_states, key_cache,
+                                             value_cache, attention_bias)
+
+        if getattr(decoder, "final_layer_norm", None) is not None:
+            hidden_states = decoder.final_layer_norm(hidden_states)
+        if decoder.project_out is not None:
+            hidden_states = decoder.project_out(hidden_states)
+        return self.lm_head(hidden_states)
+
+    def _layer_step(self, layer, hidden_states, key_cache, value_cache,
+                    attention_bias):
+        attn = layer.self_attn
+        # With one token per sequence, (batch, 1, heads * head_dim) has the
+        # same layout as (batch, heads, 1, head_dim).
+        head_shape = (hidden_states.shape[0], attn.num_heads, 1, attn.head_dim)
+
+        # Self attention
+        residual = hidden_states
+        if layer.do_layer_norm_before:
+            hidden_states = layer.self_attn_layer_norm(hidden_states)
+        query = (attn.q_proj(hidden_states) * attn.scaling).view(head_shape)
+        key_cache.index_copy_(2, self.cache_index,
+                              attn.k_proj(hidden_states).view(head_shape))
+        value_cache.index_copy_(2, self.cache_index,
+                                attn.v_proj(hidden_states).view(head_shape))
+        attn_weights = torch.matmul(query, key_cache.transpose(2, 3))
+        attn_weights = attn_weights + attention_bias
+        if attn_weights.dtype == torch.float16:
+            attn_probs = torch.softmax(attn_weights, dim=-1,
+                                       dtype=torch.float32).to(torch.float16)
+        else:
+            attn_probs = torch.softmax(attn_weights, dim=-1)
+        attn_output = torch.matmul(attn_probs, value_cache)
+        hidden_states = residual + attn.out_proj(
+            attn_output.view(residual.shape))
+        if not layer.do_layer_norm_before:
+            hidden_states = layer.self_attn_layer_norm(hidden_states)
+
+        # Fully connected
+        residual = hidden_states
+        if layer.do_layer_norm_before:
+            hidden_states = layer.final_layer_norm(hidden_states)
+        hidden_states = layer.fc2(layer.activation_fn(
+            layer.fc1(hidden_states)))
+        hidden_states = residual + hidden_states
+        if not layer.do_layer_norm_before:
+            hidden_states = layer.final_layer_norm(hidden_states)
+        return hidden_states
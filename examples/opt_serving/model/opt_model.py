@@ -31,6 +31,10 @@ ACT2FN = {
     "gelu_new": partial(nn.gelu, approximate=True),
 }
 
+# max_length is rounded up to a multiple of this many tokens to get the size
+# of the (single, static) attention cache.
+KV_CACHE_SIZE_ALIGNMENT = 16
+
 
 @flax.struct.dataclass
 class OPTModelOutput(ModelOutput):
@@ -534,18 +538,33 @@ def init_model_aval(config):
     return model, params
 
 
-def init_cache_aval(config, batch_size):
+def get_cache_size(config, max_length=None):
+    """Return the number of tokens the attention cache is allocated for.
+
+    This only rounds max_length up to a multiple of KV_CACHE_SIZE_ALIGNMENT,
+    so that short generations do not reserve (and attend over) a cache sized
+    for max_target_positions.
+    """
+    if max_length is None:
+        return config.max_target_positions
+    alignment = KV_CACHE_SIZE_ALIGNMENT
+    cache_size = (max_length + alignment - 1) // alignment * alignment
+    return min(cache_size, config.max_target_positions)
+
+
+def init_cache_aval(config, batch_size, cache_size=None):
     """Initialize cache with abstract values (shape-only arrays)."""
     dtype = config.dtype
     head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    cache_size = cache_size or config.max_target_positions
 
     all_cache = []
     for i in range(config.decoder_layers):
         layer_cache = (
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
+            jax.core.ShapedArray((batch_size, cache_size,
                                   config.decoder_attention_heads, head_dim),
                                  dtype),
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
+            jax.core.ShapedArray((batch_size, cache_size,
                                   config.decoder_attention_heads, head_dim),
                                  dtype),
             jax.core.ShapedArray((batch_size,), jnp.int32),
@@ -554,18 +573,19 @@ def init_cache_aval(config, batch_size):
     return tuple(all_cache)
 
 
-def init_cache_np(config, batch_size):
+def init_cache_np(config, batch_size, cache_size=None):
     """Init cache with numpy arrays."""
     np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
     head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    cache_size = cache_size or config.max_target_positions
 
     all_cache = []
     for i in range(config.decoder_layers):
         layer_cache = (
-            np.zeros((batch_size, config.max_target_positions,
+            np.zeros((batch_size, cache_size,
                       config.decoder_attention_heads, head_dim),
                      dtype=np_dtype),
-            np.zeros((batch_size, config.max_target_positions,
+            np.zeros((batch_size, cache_size,
                       config.decoder_attention_heads, head_dim),
                      dtype=np_dtype),
             np.zeros((batch_size,), np.int32),
@@ -687,7 +707,8 @@ def get_pipeshard_executable(config,
                              decoding_length_per_step=1024,
                              support_output_attentions=False,
                              support_output_hidden_states=False,
-                             autoregressive=True):
+                             autoregressive=True,
+                             cache_size=None):
 
     # Init model
     model, params = init_model_aval(config)
@@ -727,7 +748,7 @@ def get_pipeshard_executable(config,
                 "position_ids":
                     jax.core.ShapedArray((batch_size, 1), jnp.int32),
                 "cache":
-                    init_cache_aval(config, batch_size),
+                    init_cache_aval(config, batch_size, cache_size),
             })
     else:
 
@@ -930,9 +951,13 @@ def load_params_dis_array(path, executable, params_aval, config, dummy=False):
     return flat_arrays
 
 
-def init_cache_dis_array(executable, config, batch_size, dummy=False):
+def init_cache_dis_array(executable,
+                         config,
+                         batch_size,
+                         dummy=False,
+                         cache_size=None):
     """Initialize cache with distributed arrays."""
-    cache = init_cache_np(config, batch_size)
+    cache = init_cache_np(config, batch_size, cache_size)
     alpa.global_config.use_dummy_value_for_benchmarking = dummy
     _, batch_info = executable.get_input_placement_specs()
     flat_args, in_tree = tree_flatten(cache)
@@ -2,6 +2,7 @@
 import jax
 import jax.numpy as jnp
 import numpy as np
+import torch
 
 from alpa.testing import assert_allclose
 from opt_serving.model.opt_model import (get_opt_config, init_model_aval,
@@ -9,6 +10,7 @@ from opt_serving.model.opt_model import (get_opt_config, init_model_aval,
                                          init_cache_np,
                                          build_position_ids,
                                          load_params_np)
+from opt_serving.model.wrapper import get_model
 
 
 def print_params(params, prefix=""):
@@ -79,6 +81,44 @@ def test_opt_125M(decompose_input):
         assert_allclose(logits_step, logits_no_cache)
 
 
+def test_opt_125M_padded_prefill():
+    print("Testing cache with padded prefill")
+    model = get_model("jax/opt-125m",
+                      "cpu",
+                      "/home/ubuntu/opt_weights/",
+                      dtype=jnp.float32,
+                      max_length=64)
+    inference_func = model.inference_func
+
+    # One prompt is padded to a bucket and the other one fills a bucket
+    for prompt_len in [9, 32]:
+        input_ids = torch.arange(4, 4 + prompt_len).reshape(1, -1)
+
+        # Expected results: feed the prompt one token by one token
+        past_key_values = None
+        for i in range(prompt_len):
+            logits, past_key_values = inference_func(input_ids[:, i:i + 1],
+                                                     past_key_values)[:2]
+        logits_expected = [logits]
+        next_tokens = []
+        for _ in range(4):
+            next_tokens.append(logits[:, -1:].argmax(-1))
+            logits, past_key_values = inference_func(next_tokens[-1],
+                                                     past_key_values)[:2]
+            logits_expected.append(logits)
+
+        # Feed the prompt in a single (padded) chunk. The padding must not
+        # affect the following decoding steps.
+        logits, past_key_values = inference_func(input_ids, None)[:2]
+        assert logits.shape == logits_expected[0].shape
+        assert_allclose(logits, logits_expected[0])
+        for next_token, expected in zip(next_tokens, logits_expected[1:]):
+            logits, past_key_values = inference_func(next_token,
+                                                     past_key_values)[:2]
+            assert_allclose(logits, expected)
+
+
 if __name__ == "__main__":
     test_opt_125M(False)
     test_opt_125M(True)
+    test_opt_125M_padded_prefill()
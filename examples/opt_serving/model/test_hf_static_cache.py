@@ -0,0 +1,158 @@
+"""Test the correctness of the static attention cache of huggingface OPT models."""
+import tempfile
+
+import torch
+from transformers import OPTConfig, OPTForCausalLM
+
+from opt_serving.model.hf_static_cache import OPTStaticDecoder
+from opt_serving.model.wrapper import get_hf_opt_model, quantize_linear_int8
+
+# Pre-LN, post-LN, and different word embedding and hidden sizes
+# (project_in/project_out)
+config_kwargs_list = [
+    {},
+    {
+        "do_layer_norm_before": False
+    },
+    {
+        "word_embed_proj_dim": 16
+    },
+]
+
+
+def get_tiny_opt_model(path, **kwargs):
+    torch.manual_seed(0)
+    config = OPTConfig(vocab_size=100,
+                       hidden_size=32,
+                       num_hidden_layers=2,
+                       ffn_dim=64,
+                       num_attention_heads=4,
+                       max_position_embeddings=64,
+                       **kwargs)
+    raw_model = OPTForCausalLM(config).eval()
+    raw_model.save_pretrained(path)
+    return raw_model
+
+
+def test_static_decoder_logits():
+    input_ids = torch.tensor([[2, 11, 17, 5, 9, 33, 7]])
+
+    for kwargs in config_kwargs_list:
+        print("Testing static decoder logits with config %s" % kwargs)
+        with tempfile.TemporaryDirectory() as path, torch.no_grad():
+            raw_model = get_tiny_opt_model(path, **kwargs)
+            out = raw_model(input_ids=input_ids, use_cache=True)
+            past_key_values = out.past_key_values
+
+            static_decoder = OPTStaticDecoder(raw_model,
+                                              batch_size=1,
+                                              max_length=32,
+                                              use_cuda_graph=False)
+            static_decoder.cache.fill(past_key_values)
+
+            next_token = out.logits[:, -1:].argmax(-1)
+            for i in range(8):
+                attention_mask = torch.ones(
+                    (1, input_ids.shape[1] + i + 1), dtype=torch.long)
+                out = raw_model(input_ids=next_token,
+                                attention_mask=attention_mask,
+                                past_key_values=past_key_values,
+                                use_cache=True)
+                past_key_values = out.past_key_values
+                logits = static_decoder.decode(next_token)
+                torch.testing.assert_close(logits, out.logits)
+                next_token = out.logits[:, -1:].argmax(-1)
+
+
+def test_static_cache_generate():
+    input_ids = torch.tensor([[2, 11, 17, 5, 9, 33, 7]])
+
+    for kwargs in config_kwargs_list:
+        for num_beams in [1, 4]:
+            print("Testing static cache generate with config %s, num_beams=%d" %
+                  (kwargs, num_beams))
+            with tempfile.TemporaryDirectory() as path, torch.no_grad():
+                raw_model = get_tiny_opt_model(path, **kwargs)
+                model = get_hf_opt_model(path,
+                                         "cpu",
+                                         num_beams,
+                                         cuda_graph=True,
+                                         max_length=24)
+                expected = raw_model.generate(input_ids=input_ids,
+                                              max_length=24,
+                                              do_sample=False,
+                                              num_beams=num_beams)
+                # Run twice to reuse the static cache across generations
+                for _ in range(2):
+                    output = model.generate(input_ids=input_ids,
+                                            max_length=24,
+                                            do_sample=False,
+                                            num_beams=num_beams)
+                    assert torch.equal(output, expected)
+
+
+def test_fast_generate():
+    input_ids = torch.tensor([[2, 11, 17, 5, 9, 33, 7], [2, 8, 3, 4, 4, 6, 9]])
+
+    for cuda_graph in [False, True]:
+        print("Testing fast_generate with cuda_graph=%s" % cuda_graph)
+        with tempfile.TemporaryDirectory() as path:
+            raw_model = get_tiny_opt_model(path)
+            model = get_hf_opt_model(path,
+                                     "cpu",
+                                     num_beams=1,
+                                     cuda_graph=cuda_graph,
+                                     max_length=24)
+            expected = raw_model.generate(input_ids=input_ids,
+                                          max_length=24,
+                                          do_sample=False)
+            output = model.fast_generate(input_ids, max_length=24)
+            assert torch.equal(output, expected)
+
+            # The prompt is already longer than max_length
+            output = model.fast_generate(input_ids, max_length=4)
+            assert torch.equal(output, input_ids)
+
+
+def test_quantized_lm_head():
+    input_ids = torch.tensor([[2, 11, 17, 5, 9, 33, 7]])
+
+    with tempfile.TemporaryDirectory() as path, torch.no_grad():
+        raw_model = get_tiny_opt_model(path)
+
+        # The int8 logits are close to the float ones
+        hidden_states = torch.randn((4, 1, raw_model.config.hidden_size))
+        quantized = quantize_linear_int8(raw_model.lm_head, "cpu")
+        expected = raw_model.lm_head(hidden_states)
+        torch.testing.assert_close(quantized(hidden_states),
+                                   expected,
+                                   rtol=0,
+                                   atol=0.05 * expected.abs().max().item())
+
+        for cuda_graph in [False, True]:
+            print("Testing quantized lm_head with cuda_graph=%s" % cuda_graph)
+            model = get_hf_opt_model(path,
+                                     "cpu",
+                                     num_beams=1,
+                                     cuda_graph=cuda_graph,
+                                     max_length=24)
+            quantized_model = get_hf_opt_model(path,
+                                               "cpu",
+                                               num_beams=1,
+                                               cuda_graph=cuda_graph,
+                                               max_length=24,
+                                               quantize_lm_head=True)
+            expected = model.generate(input_ids=input_ids,
+                                      max_length=24,
+                                      do_sample=False)
+            output = quantized_model.generate(input_ids=input_ids,
+                                              max_length=24,
+                                              do_sample=False)
+            assert torch.equal(output, expected)
+
+
+if __name__ == "__main__":
+    test_static_decoder_logits()
+    test_static_cache_generate()
+    test_fast_generate()
+    test_quantized_lm_head()
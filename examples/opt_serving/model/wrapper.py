@@ -16,14 +16,22 @@ import torch
 from transformers.generation_utils import GenerationMixin, ModelOutput, dataclass
 from transformers import OPTForCausalLM, GPT2LMHeadModel
 
+from opt_serving.model.hf_static_cache import OPTStaticDecoder, StaticKVCache
 from opt_serving.model.opt_model import (
     get_opt_config, get_pipeshard_executable, load_params_dis_array,
-    init_cache_dis_array, load_params_np, init_cache_np, get_jax_executable)
+    init_cache_dis_array, load_params_np, init_cache_np, get_jax_executable,
+    get_cache_size)
 from opt_serving.model.opt_utils import (TransformerModelConfig,
                                                   jax_index_select,
                                                   is_power_of_two)
 
 
+# The input lengths that the jax executable is traced for. Prompt chunks are
+# padded to the nearest one, so that the executable is not retraced for every
+# prompt length.
+JAX_SEQ_LEN_BUCKETS = (1, 32, 128)
+
+
 @dataclass
 class InferenceFuncOutput(ModelOutput):
     logits: Any = None
@@ -73,15 +81,29 @@ class WrappedInferenceFunc(GenerationMixin):
     Wrap an inference func as a GenerationMixin.
     This class implements the minimal interface for using huggingface's generator.
 
-    This class also decomposes the first call of prompt during generation to one token by one token.
+    The inference func returns a plain tuple of (logits, past_key_values,
+    [hidden_states, attentions]), which is wrapped into an InferenceFuncOutput
+    only once per call.
+
+    The prompt is fed to the inference func in chunks of at most
+    `prefill_chunk_size` tokens. If it is None, the whole prompt is processed
+    in a single prefill call. Executables compiled for a fixed input length
+    (e.g., alpa) use prefill_chunk_size=1 to decompose the prompt to one token
+    by one token.
     """
 
-    def __init__(self, inference_func, config, executable, transformer_config):
+    def __init__(self,
+                 inference_func,
+                 config,
+                 executable,
+                 transformer_config,
+                 prefill_chunk_size=None):
         self.inference_func = inference_func
         self.config = config
         self.main_input_name = "input_ids"
         self.executable = executable
         self.transformer_config = transformer_config
+        self.prefill_chunk_size = prefill_chunk_size
         self.index_select_executables = {}
         self.cache_location = None
 
@@ -105,18 +127,100 @@ class WrappedInferenceFunc(GenerationMixin):
                  output_attentions=None,
                  output_hidden_states=None,
                  return_dict=None):
-        # Decompose the call to token by token
-        for i in range(input_ids.shape[1]):
-            ret = self.inference_func(input_ids[:, i:i + 1],
-                                      past_key_values,
-                                      output_hidden_states=output_hidden_states,
-                                      output_attentions=output_attentions)
-            past_key_values = ret.past_key_values
+        if output_attentions or output_hidden_states:
+            kwargs = {
+                "output_attentions": output_attentions,
+                "output_hidden_states": output_hidden_states
+            }
+        else:
+            kwargs = {}
+        return InferenceFuncOutput(
+            *self._forward(input_ids, past_key_values, kwargs))
+
+    def _forward(self, input_ids, past_key_values, kwargs):
+        """Run the inference func and return its output tuple."""
+        inference_func = self.inference_func
+
+        # Prefill the prompt in as few calls as the inference func supports.
+        # During decoding, input_ids only contains the last token.
+        seq_len = input_ids.shape[1]
+        chunk_size = self.prefill_chunk_size or seq_len
+        if chunk_size >= seq_len:
+            return inference_func(input_ids, past_key_values, **kwargs)
+        for i in range(0, seq_len, chunk_size):
+            ret = inference_func(input_ids[:, i:i + chunk_size],
+                                 past_key_values, **kwargs)
+            past_key_values = ret[1]
         return ret
 
+    @torch.no_grad()
+    def fast_generate(self,
+                      input_ids,
+                      max_length,
+                      do_sample=False,
+                      temperature=1.0,
+                      top_k=0):
+        """Generate with a minimal greedy/top-k sampling loop.
+
+        This bypasses huggingface's generate, which builds logits processors,
+        stopping criteria and output dicts on every call and step. Use
+        generate for beam search and the other generation options.
+
+        Returns:
+            The generated sequences (prompt included), padded with
+            pad_token_id after eos_token_id.
+        """
+        eos_token_id = self.config.eos_token_id
+        pad_token_id = self.config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id
+
+        batch_size, cur_len = input_ids.shape
+        if cur_len >= max_length:
+            # Nothing to generate, as in huggingface's generate
+            return input_ids
+        sequences = torch.empty((batch_size, max_length),
+                                dtype=input_ids.dtype,
+                                device=input_ids.device)
+        sequences[:, :cur_len] = input_ids
+        unfinished = torch.ones(batch_size,
+                                dtype=torch.bool,
+                                device=input_ids.device)
+        past_key_values = None
+        while cur_len < max_length:
+            logits, past_key_values = self._forward(input_ids,
+                                                    past_key_values, {})[:2]
+            logits = logits[:, -1]
+            if do_sample:
+                if temperature != 1.0:
+                    logits = logits / temperature
+                if top_k > 0:
+                    logits, top_indices = torch.topk(logits, top_k)
+                probs = torch.softmax(logits.float(), dim=-1)
+                next_tokens = torch.multinomial(probs, 1)
+                if top_k > 0:
+                    next_tokens = top_indices.gather(-1, next_tokens)
+            else:
+                next_tokens = logits.argmax(dim=-1, keepdim=True)
+
+            if eos_token_id is not None:
+                next_tokens.masked_fill_(~unfinished[:, None], pad_token_id)
+                unfinished &= next_tokens[:, 0] != eos_token_id
+            sequences[:, cur_len:cur_len + 1] = next_tokens
+            cur_len += 1
+            input_ids = next_tokens
+            if eos_token_id is not None and not unfinished.any():
+                break
+        return sequences[:, :cur_len]
+
     def _reorder_cache(self, past, beam_idx):
         # Reorder cache for beam search
 
+        # PyTorch static cache (in place)
+        if isinstance(past, StaticKVCache):
+            past.reorder(beam_idx)
+            return past
+
         # PyTorch
         if hasattr(past[0][0], "index_select"):
             return tuple(
@@ -184,19 +288,30 @@ class WrappedInferenceFunc(GenerationMixin):
             for layer_loc in self.cache_location)
 
 
-def get_hf_gpt_model(model_name, device, num_beams):
+def get_hf_gpt_model(model_name, device, num_beams, torch_compile=False):
+    # The huggingface models use the eager attention. Loading them with
+    # torch's scaled_dot_product_attention needs transformers >= 4.36
+    # (attn_implementation), but this module relies on
+    # transformers.generation_utils, which needs transformers < 4.26.
     raw_model = GPT2LMHeadModel.from_pretrained(model_name)
     raw_model = raw_model.to(device)
+    transformer = raw_model.transformer
+    if torch_compile:
+        transformer = compile_hf_model(transformer)
+    lm_head = raw_model.lm_head
 
     def inference_func(input_ids,
                        past_key_values,
                        output_attentions=False,
                        output_hidden_states=False):
-        out = raw_model(input_ids=input_ids,
-                        past_key_values=past_key_values,
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states)
-        return InferenceFuncOutput(out.logits, out.past_key_values)
+        out = transformer(input_ids=input_ids,
+                          past_key_values=past_key_values,
+                          output_attentions=output_attentions,
+                          output_hidden_states=output_hidden_states)
+        # The generator only uses the logits of the last token, so skip
+        # the lm_head for the other prompt tokens.
+        logits = lm_head(out.last_hidden_state[:, -1:])
+        return logits, out.past_key_values
 
     inference_func_config = raw_model.config
     inference_func_config.num_beams = num_beams
@@ -211,28 +326,81 @@ def get_hf_gpt_model(model_name, device, num_beams):
                                 executable, transformer_config)
 
 
-def get_hf_opt_model(model_name, device, num_beams):
+def get_hf_opt_model(model_name,
+                     device,
+                     num_beams,
+                     torch_compile=False,
+                     cuda_graph=False,
+                     max_length=None,
+                     quantize_lm_head=False):
     raw_model = OPTForCausalLM.from_pretrained(
         model_name,
         torch_dtype=torch.float16 if "cuda" in device else torch.float32)
     raw_model = raw_model.to(device)
+    if quantize_lm_head:
+        raw_model.lm_head = quantize_linear_int8(raw_model.lm_head, device)
+    decoder = raw_model.model.decoder
+    if torch_compile:
+        decoder = compile_hf_model(decoder)
+    lm_head = raw_model.lm_head
+
+    # All-ones attention masks of the max length, keyed by batch size.
+    # Each step uses a slice of them instead of allocating a new mask.
+    max_positions = raw_model.config.max_position_embeddings
+    attention_masks = {}
+
+    # Decoders that run the decoding steps on a static cache, keyed by
+    # batch size.
+    static_decoders = {}
 
     def inference_func(input_ids,
                        past_key_values,
                        output_attentions=False,
                        output_hidden_states=False):
+        batch_size, seq_len = input_ids.shape
+        if isinstance(past_key_values, StaticKVCache):
+            if output_attentions or output_hidden_states:
+                raise NotImplementedError(
+                    "cuda_graph does not support output_attentions or "
+                    "output_hidden_states")
+            static_decoder = static_decoders[batch_size]
+            for i in range(seq_len):
+                logits = static_decoder.decode(input_ids[:, i:i + 1])
+            return logits, past_key_values
+
         if past_key_values is None:
             attention_mask = None
         else:
             past_length = past_key_values[0][0].shape[2]
-            attention_mask = torch.ones(
-                (input_ids.shape[0], past_length + 1)).to(device)
-        out = raw_model(input_ids=input_ids,
-                        attention_mask=attention_mask,
-                        past_key_values=past_key_values,
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states)
-        return InferenceFuncOutput(out.logits, out.past_key_values)
+            attention_mask = attention_masks.get(batch_size)
+            if attention_mask is None:
+                attention_mask = torch.ones((batch_size, max_positions),
+                                            dtype=torch.long,
+                                            device=device)
+                attention_masks[batch_size] = attention_mask
+            attention_mask = attention_mask[:, :past_length + seq_len]
+        out = decoder(input_ids=input_ids,
+                      attention_mask=attention_mask,
+                      past_key_values=past_key_values,
+                      output_attentions=output_attentions,
+                      output_hidden_states=output_hidden_states)
+        # The generator only uses the logits of the last token, so skip
+        # the lm_head for the other prompt tokens.
+        logits = lm_head(out.last_hidden_state[:, -1:])
+
+        if cuda_graph and past_key_values is None:
+            # Move the prefilled cache to a static cache for decoding.
+            static_decoder = static_decoders.get(batch_size)
+            if static_decoder is None:
+                static_decoder = OPTStaticDecoder(
+                    raw_model,
+                    batch_size,
+                    max_length or max_positions,
+                    use_cuda_graph="cuda" in device)
+                static_decoders[batch_size] = static_decoder
+            static_decoder.cache.fill(out.past_key_values)
+            return logits, static_decoder.cache
+        return logits, out.past_key_values
 
     inference_func_config = InferenceFuncConfig(num_beams=num_beams)
     for key in inference_func_config.__dataclass_fields__.keys():
@@ -248,6 +416,44 @@ def get_hf_opt_model(model_name, device, num_beams):
                                 executable, transformer_config)
 
 
+def compile_hf_model(module):
+    """Compile (a submodule of) a huggingface model with torch.compile.
+
+    The length of past_key_values grows by one every decoding step, so the
+    module is compiled with dynamic shapes to avoid recompiling every step.
+    """
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("torch_compile requires PyTorch >= 2.0")
+    return torch.compile(module, dynamic=True)
+
+
+def quantize_linear_int8(linear, device):
+    """Quantize the weight of a torch.nn.Linear to int8.
+
+    On CPUs, the linear is dynamically quantized by pytorch. On GPUs, it is
+    replaced by a bitsandbytes Linear8bitLt, which requires bitsandbytes.
+    """
+    if "cuda" not in device:
+        return torch.ao.quantization.quantize_dynamic(
+            torch.nn.Sequential(linear), {torch.nn.Linear},
+            dtype=torch.qint8)[0]
+
+    try:
+        import bitsandbytes as bnb
+    except ImportError:
+        raise ImportError(
+            "Quantizing on GPUs requires bitsandbytes: "
+            "`pip install bitsandbytes`")
+    quantized = bnb.nn.Linear8bitLt(linear.in_features,
+                                    linear.out_features,
+                                    bias=linear.bias is not None,
+                                    has_fp16_weights=False,
+                                    threshold=6.0)
+    quantized.load_state_dict(linear.state_dict())
+    # The weight is quantized when it is moved to the GPU.
+    return quantized.to(device)
+
+
 def get_model(model_name: str,
               device: str,
               path: str,
@@ -261,14 +467,30 @@ def get_model(model_name: str,
               decoding_length_per_step=1,
               num_micro_batches=1,
               support_output_attentions=False,
-              support_output_hidden_states=False):
+              support_output_hidden_states=False,
+              max_length=None,
+              torch_compile=False,
+              cuda_graph=False,
+              quantize_lm_head=False):
     """Get and load model and return a WrappedInferenceFunc compatible with HuggingFace.
 
     Args:
         model_name: "gpt", "facebook/opt-", or "alpa/opt-".
         device: "cpu" or "gpu". This only controls the device used
-          by pytorch. Alpa always runs on GPU.
+          by pytorch. Alpa always runs on GPU. For jax/alpa models, "cpu"
+          keeps input_ids and logits on the host and avoids the
+          host-to-device copies of every decoding step.
         path: The path to opt weights.
+        max_length: The maximum length (prompt included) of the generated
+          sequences. The attention cache of jax/alpa models (and of
+          facebook/opt models with cuda_graph) is only allocated for this
+          length. Defaults to the max positions of the model.
+        torch_compile: Whether to compile huggingface models with
+          torch.compile.
+        cuda_graph: Whether to run the decoding steps of facebook/opt models
+          on a static attention cache, captured in a CUDA graph on GPUs.
+        quantize_lm_head: Whether to quantize the lm_head of facebook/opt
+          models to int8. It cannot be combined with cuda_graph on GPUs.
     """
     if not model_name.startswith("alpa") and not autoregressive:
         raise NotImplementedError(
@@ -279,11 +501,27 @@ def get_model(model_name: str,
     if autoregressive and num_micro_batches > 1:
         raise NotImplementedError(
             f"Cannot support num_micro_batches > 1 in autoregressive mode.")
+    if torch_compile and ("jax/opt" in model_name or
+                          "alpa/opt" in model_name):
+        raise NotImplementedError(
+            f"Cannot support torch_compile for {model_name}.")
+    if cuda_graph and "facebook/opt" not in model_name:
+        raise NotImplementedError(
+            f"Cannot support cuda_graph for {model_name}.")
+    if quantize_lm_head and "facebook/opt" not in model_name:
+        raise NotImplementedError(
+            f"Cannot support quantize_lm_head for {model_name}.")
+    if quantize_lm_head and cuda_graph and "cuda" in device:
+        # The outlier decomposition of bitsandbytes syncs with the host,
+        # which is not allowed during CUDA graph capture.
+        raise NotImplementedError(
+            "Cannot support quantize_lm_head with cuda_graph on GPUs.")
 
     if "gpt" in model_name:
-        return get_hf_gpt_model(model_name, device, num_beams)
+        return get_hf_gpt_model(model_name, device, num_beams, torch_compile)
     if "facebook/opt" in model_name:
-        return get_hf_opt_model(model_name, device, num_beams)
+        return get_hf_opt_model(model_name, device, num_beams, torch_compile,
+                                cuda_graph, max_length, quantize_lm_head)
 
     assert ("jax/opt" in model_name or "alpa/opt" in model_name)
     name = model_name.split("-")[1].upper()
@@ -307,11 +545,12 @@ def get_model(model_name: str,
                                 num_pp_stages=None,
                                 mark_boundary=False,
                                 dtype=dtype)
+        cache_size = get_cache_size(config, max_length)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
             n_head=config.decoder_attention_heads,
-            seq_len=config.max_target_positions,
+            seq_len=cache_size,
             vocab_size=config.vocab_size)
 
         executable, params_aval = get_jax_executable(
@@ -321,7 +560,9 @@ def get_model(model_name: str,
 
         # load params
         params = load_params_np(params_aval, path, config, dummy)
-        init_cache = init_cache_np(config, batch_size=expand_size)
+        init_cache = init_cache_np(config,
+                                   batch_size=expand_size,
+                                   cache_size=cache_size)
         params, init_cache = jax.tree_map(jnp.array, (params, init_cache))
     else:
         assert "alpa/opt" in model_name
@@ -337,11 +578,12 @@ def get_model(model_name: str,
         num_pp_stages = min(num_pp_stages,
                             alpa.get_global_cluster().num_devices)
         config = get_opt_config(name, num_pp_stages=num_pp_stages, dtype=dtype)
+        cache_size = get_cache_size(config, max_length)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
             n_head=config.decoder_attention_heads,
-            seq_len=config.max_target_positions,
+            seq_len=cache_size,
             vocab_size=config.vocab_size)
 
         if autoregressive:
@@ -353,7 +595,8 @@ def get_model(model_name: str,
             decoding_length_per_step=decoding_length_per_step,
             support_output_attentions=support_output_attentions,
             support_output_hidden_states=support_output_hidden_states,
-            autoregressive=autoregressive)
+            autoregressive=autoregressive,
+            cache_size=cache_size)
 
         # load params
         params = load_params_dis_array(path, executable, params_aval, config,
@@ -362,7 +605,8 @@ def get_model(model_name: str,
             init_cache = init_cache_dis_array(executable,
                                               config,
                                               expand_size,
-                                              dummy=dummy)
+                                              dummy=dummy,
+                                              cache_size=cache_size)
             set_skip_shard_args_check(init_cache)
         executable.sync()
 
@@ -370,7 +614,36 @@ def get_model(model_name: str,
         if not autoregressive:
             return executable, params, transformer_config
 
+    if "jax/opt" in model_name:
+        seq_len_buckets = JAX_SEQ_LEN_BUCKETS
+    else:
+        # The alpa executable is only compiled for a single token per step.
+        # Executables compiled for other lengths may shard the params
+        # differently, so they cannot share them.
+        seq_len_buckets = (1,)
+
     step_ct = 0
+    position_offset = config.pad + 1
+    decode_position_ids = np.empty((expand_size, 1), dtype=np.int32)
+    # Pinned host buffer of the logits, so that they are copied to the GPU
+    # without blocking the host.
+    logits_host = None
+    logits_copied = None
+
+    def logits_to_device(logits):
+        nonlocal logits_host, logits_copied
+        if "cuda" not in device:
+            return torch.from_numpy(logits).to(device)
+        if logits_host is None or logits_host.shape != logits.shape:
+            logits_host = torch.from_numpy(logits).pin_memory()
+            logits_copied = torch.cuda.Event()
+        else:
+            # The copy of the previous step may still read the buffer.
+            logits_copied.synchronize()
+            logits_host.numpy()[...] = logits
+        logits_device = logits_host.to(device, non_blocking=True)
+        logits_copied.record()
+        return logits_device
 
     def inference_func(input_ids,
                        past_key_values,
@@ -383,8 +656,32 @@ def get_model(model_name: str,
             step_ct = 0
 
         input_ids_step = input_ids.cpu().numpy()
-        position_ids_step = np.full_like(input_ids_step,
-                                         step_ct + config.pad + 1)
+        batch_size, seq_len = input_ids_step.shape
+        if step_ct + seq_len > cache_size:
+            raise RuntimeError(
+                f"The sequence length exceeds the attention cache size "
+                f"({cache_size}). Increase max_length in get_model.")
+        # Pad the input to the smallest bucket that fits in the cache. The
+        # padding tokens come after the real tokens, so the causal mask keeps
+        # them from affecting the real ones.
+        padded_len = seq_len
+        if not (output_attentions or output_hidden_states):
+            for bucket in seq_len_buckets:
+                if seq_len <= bucket and step_ct + bucket <= cache_size:
+                    padded_len = bucket
+                    break
+        if padded_len > seq_len:
+            input_ids_step = np.pad(input_ids_step,
+                                    ((0, 0), (0, padded_len - seq_len)),
+                                    constant_values=config.pad)
+
+        if input_ids_step.shape == decode_position_ids.shape:
+            position_ids_step = decode_position_ids
+            position_ids_step.fill(step_ct + position_offset)
+        else:
+            position_ids_step = np.tile(
+                np.arange(step_ct, step_ct + padded_len, dtype=np.int32) +
+                position_offset, (batch_size, 1))
 
         output = executable(
             params, {
@@ -392,17 +689,39 @@ def get_model(model_name: str,
                 "position_ids": position_ids_step,
                 "cache": past_key_values,
             })
-        set_skip_shard_args_check(output.attention_cache)
-
-        logits_step = torch.from_numpy(np.array(output.logits)).to(device)
+        attention_cache = output.attention_cache
+        logits = output.logits
+        if seq_len > 1:
+            # The generator only uses the logits of the last real token, so
+            # do not fetch the others to the host.
+            logits = logits[:, seq_len - 1:seq_len]
+        if padded_len > seq_len:
+            # Rewind the cache index so that the next step overwrites the
+            # padding.
+            attention_cache = tuple(
+                (key, value, index - (padded_len - seq_len))
+                for key, value, index in attention_cache)
+        set_skip_shard_args_check(attention_cache)
+
+        if isinstance(logits, DistributedArray):
+            # Reuse the host buffer fetched by the DistributedArray
+            # instead of copying it again.
+            logits_step = np.asarray(logits)
+        else:
+            logits_step = np.array(logits)
+        logits_step = logits_to_device(logits_step)
 
-        step_ct += 1
-        return InferenceFuncOutput(logits_step, output.attention_cache,
-                                   output.hidden_states, output.attentions)
+        step_ct += seq_len
+        return (logits_step, attention_cache, output.hidden_states,
+                output.attentions)
 
     inference_func_config = InferenceFuncConfig(num_beams=num_beams)
-    return WrappedInferenceFunc(inference_func, inference_func_config,
-                                executable, transformer_config)
+    # The prompt is fed in chunks of at most the largest bucket.
+    return WrappedInferenceFunc(inference_func,
+                                inference_func_config,
+                                executable,
+                                transformer_config,
+                                prefill_chunk_size=max(seq_len_buckets))
 
 
 def set_skip_shard_args_check(attention_cache):